@@ -7,9 +7,11 @@
 #
 ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
 """Linear transforms."""
+import os
 import warnings
 import numpy as np
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
 from scipy import ndimage as ndi
 
 from nibabel.loadsave import load as _nbload
@@ -20,16 +22,20 @@ from nitransforms.base import (
     ImageGrid,
     TransformBase,
     SpatialReference,
-    _as_homogeneous,
     EQUALITY_TOL,
 )
 from nitransforms.io import get_linear_factory, TransformFileError
 
+# Number of samples resampled at once by LinearTransformsMapping.apply
+_BLOCK_SIZE = 2**20
+# Largest 4D data array (in bytes) LinearTransformsMapping.apply reads at once
+_PRELOAD_MAX_BYTES = 2**30
+
 
 class Affine(TransformBase):
     """Represents linear transforms on image data."""
 
-    __slots__ = ("_matrix", "_inverse")
+    __slots__ = ("_matrix", "_inverse_matrix")
 
     def __init__(self, matrix=None, reference=None):
         """
@@ -62,7 +68,7 @@ class Affine(TransformBase):
         """
         super().__init__(reference=reference)
         self._matrix = np.eye(4)
-        self._inverse = np.eye(4)
+        self._inverse_matrix = None
 
         if matrix is not None:
             matrix = np.array(matrix)
@@ -81,7 +87,6 @@ should be (0, 0, 0, 1), got %s."""
 
             # Normalize last row
             self._matrix[3, :] = (0, 0, 0, 1)
-            self._inverse = np.linalg.inv(self._matrix)
 
     def __eq__(self, other):
         """
@@ -95,7 +100,12 @@ should be (0, 0, 0, 1), got %s."""
         True
 
         """
-        _eq = np.allclose(self.matrix, other.matrix, rtol=EQUALITY_TOL)
+        # Exact matches (e.g., copies) are far cheaper to check than tolerance
+        _eq = (
+            self.matrix is other.matrix
+            or np.array_equal(self.matrix, other.matrix)
+            or np.allclose(self.matrix, other.matrix, rtol=EQUALITY_TOL)
+        )
         if _eq and self._reference != other._reference:
             warnings.warn("Affines are equal, but references do not match.")
         return _eq
@@ -133,9 +143,17 @@ should be (0, 0, 0, 1), got %s."""
         else:
             _b = b
 
-        retval = self.__class__(self.matrix.dot(_b.matrix))
-        if _b.reference:
-            retval.reference = _b.reference
+        if _b._matrix.ndim == 2:
+            # The product of two homogeneous matrices is homogeneous, so there
+            # is no need to validate (nor invert) it at this point
+            retval = self.__class__()
+            retval._matrix = self._matrix.dot(_b._matrix)
+        else:
+            # Subclasses holding a series of matrices (which compose with
+            # ``__rmatmul__``) must not slip an ill-formed result through
+            retval = self.__class__(self._matrix.dot(_b._matrix))
+        if _b._reference:
+            retval.reference = _b._reference
         return retval
 
     @property
@@ -143,6 +161,13 @@ should be (0, 0, 0, 1), got %s."""
         """Access the internal representation of this affine."""
         return self._matrix
 
+    @property
+    def _inverse(self):
+        """Access the inverse of the internal matrix, computed on first use."""
+        if self._inverse_matrix is None:
+            self._inverse_matrix = _affine_inv(self._matrix)
+        return self._inverse_matrix
+
     @property
     def ndim(self):
         """Access the internal representation of this affine."""
@@ -174,17 +199,32 @@ should be (0, 0, 0, 1), got %s."""
         array([[-1., -2., -3.]])
 
         """
-        affine = self._matrix
-        coords = _as_homogeneous(x, dim=affine.shape[0] - 1).T
-        if inverse is True:
-            affine = self._inverse
-        return affine.dot(coords).T[..., :-1]
+        affine = self._inverse if inverse is True else self._matrix
+        dim = affine.shape[0] - 1
+
+        # Split into linear block and translation to avoid homogeneous padding
+        coords = np.atleast_2d(
+            np.asarray(x, dtype=np.result_type(affine.dtype, "float32"))
+        )
+
+        # Write the product into a contiguous array and translate it in-place.
+        # A contiguous copy of the (small) transposed linear block is much
+        # faster to multiply by than the strided view.
+        y = np.empty(coords.shape[:-1] + (dim,), dtype=coords.dtype)
+        np.matmul(coords[..., :dim], np.ascontiguousarray(affine[:dim, :dim].T), out=y)
+        if coords.shape[-1] > dim:
+            # Homogeneous coordinates: translations scale with w (e.g., w = 0
+            # for vectors, which are not translated)
+            y += coords[..., dim:dim + 1] * affine[:dim, dim]
+        else:
+            y += affine[:dim, dim]
+        return y
 
     def _to_hdf5(self, x5_root):
         """Serialize this object into the x5 file format."""
         xform = x5_root.create_dataset("Transform", data=[self._matrix])
         xform.attrs["Type"] = "affine"
-        x5_root.create_dataset("Inverse", data=[(~self).matrix])
+        x5_root.create_dataset("Inverse", data=[self._inverse])
 
         if self._reference:
             self.reference._to_hdf5(x5_root.create_group("Reference"))
@@ -209,6 +249,12 @@ should be (0, 0, 0, 1), got %s."""
         """Create an affine from a transform file."""
         fmtlist = [fmt] if fmt is not None else ("itk", "lta", "afni", "fsl")
 
+        if fmt is None:
+            # Attempt the format the file looks like first
+            sniffed = _sniff_format(filename)
+            if sniffed is not None:
+                fmtlist = (sniffed,) + tuple(f for f in fmtlist if f != sniffed)
+
         if fmt is not None and not Path(filename).exists():
             if fmt != "fsl":
                 raise FileNotFoundError(
@@ -312,14 +358,72 @@ class LinearTransformsMapping(Affine):
         """
         super().__init__(reference=reference)
 
-        self._matrix = np.stack(
-            [
-                (xfm if isinstance(xfm, Affine) else Affine(xfm)).matrix
-                for xfm in transforms
-            ],
-            axis=0,
-        )
-        self._inverse = np.linalg.inv(self._matrix)
+        if isinstance(transforms, np.ndarray) and transforms.ndim == 3:
+            # Validate stacks of matrices at once, rather than one by one
+            self._matrix = np.array(transforms)
+            if self._matrix.shape[1] != self._matrix.shape[2]:
+                raise TypeError("Matrix is not square.")
+
+            if not np.allclose(self._matrix[:, 3, :], (0, 0, 0, 1)):
+                raise ValueError(
+                    "The last row of a homogeneus matrix should be (0, 0, 0, 1)."
+                )
+
+            # Normalize last rows
+            self._matrix[:, 3, :] = (0, 0, 0, 1)
+        else:
+            self._matrix = np.stack(
+                [
+                    (xfm if isinstance(xfm, Affine) else Affine(xfm)).matrix
+                    for xfm in transforms
+                ],
+                axis=0,
+            )
+        self._split_matrix = {}
+
+    def __matmul__(self, b):
+        """
+        Compose every transform of the series with another transform.
+
+        Composing with an affine (or with a series of the same length,
+        pairwise) is a single batched product over the whole stack.
+
+        Example
+        -------
+        >>> xfm = LinearTransformsMapping([
+        ...     [[1., 0, 0, 1.], [0, 1., 0, 2.], [0, 0, 1., 3.], [0, 0, 0, 1.]],
+        ...     [[2., 0, 0, 0.], [0, 2., 0, 0.], [0, 0, 2., 0.], [0, 0, 0, 1.]],
+        ... ])
+        >>> (xfm @ Affine.from_matvec(vec=(1, 1, 1))).matrix[:, :3, 3]
+        array([[2., 3., 4.],
+               [2., 2., 2.]])
+
+        >>> (Affine.from_matvec(vec=(1, 1, 1)) @ xfm).matrix[:, :3, 3]
+        array([[2., 3., 4.],
+               [1., 1., 1.]])
+
+        >>> (xfm @ ~xfm) == LinearTransformsMapping([np.eye(4), np.eye(4)])
+        True
+
+        """
+        if isinstance(b, Affine):
+            _b = b
+        else:
+            # Anything but a single matrix (e.g., a list of Affines) is a series
+            _b = (Affine if np.ndim(b) == 2 else LinearTransformsMapping)(b)
+
+        retval = self.__class__(np.matmul(self._matrix, _b._matrix))
+        if _b._reference:
+            retval.reference = _b._reference
+        return retval
+
+    def __rmatmul__(self, a):
+        """Compose an affine with every transform of the series (see ``__matmul__``)."""
+        _a = a if isinstance(a, Affine) else Affine(a)
+        retval = self.__class__(np.matmul(_a._matrix, self._matrix))
+        if self._reference:
+            retval.reference = self._reference
+        return retval
 
     def __iter__(self):
         """Enable iterating over the series of transforms."""
@@ -347,8 +451,10 @@ class LinearTransformsMapping(Affine):
 
         Returns
         -------
-        y : N x D numpy.ndarray
-            Transformed (mapped) RAS+ coordinates (i.e., physical coordinates).
+        y : T x N x D numpy.ndarray
+            Transformed (mapped) RAS+ coordinates (i.e., physical coordinates),
+            one N x D block per transform in the series, in a C-contiguous
+            array.
 
         Examples
         --------
@@ -368,24 +474,53 @@ class LinearTransformsMapping(Affine):
                 [ 0.,  0.,  0.,  1.]]])
 
         >>> y = xfm.map([(0, 0, 0), (-1, -1, -1), (1, 1, 1)])
-        >>> y[0, :, :3]
+        >>> y.shape
+        (2, 3, 3)
+        >>> y[0]
         array([[1., 2., 3.],
                [0., 1., 2.],
                [2., 3., 4.]])
 
         >>> y = xfm.map([(0, 0, 0), (-1, -1, -1), (1, 1, 1)], inverse=True)
-        >>> y[0, :, :3]
+        >>> y[0]
         array([[-1., -2., -3.],
                [-2., -3., -4.],
                [ 0., -1., -2.]])
 
 
         """
-        affine = self.matrix
-        coords = _as_homogeneous(x, dim=affine.shape[-1] - 1).T
-        if inverse is True:
-            affine = self._inverse
-        return np.swapaxes(affine.dot(coords), 1, 2)
+        linear, translation = self._split(inverse=inverse is True)
+        dim = translation.shape[-1]
+        coords = np.atleast_2d(
+            np.asarray(x, dtype=np.result_type(linear.dtype, "float32"))
+        )
+
+        # Batched multiplication by the linear blocks into a contiguous array,
+        # then add translations in-place (scaled by w if homogeneous)
+        y = np.empty((len(linear),) + coords.shape[:-1] + (dim,), dtype=coords.dtype)
+        np.matmul(coords[..., :dim], linear, out=y)
+        if coords.shape[-1] > dim:
+            y += coords[..., dim:dim + 1] * translation[:, np.newaxis, :]
+        else:
+            y += translation[:, np.newaxis, :]
+        return y
+
+    def _split(self, inverse=False):
+        """
+        Get contiguous stacks of the (transposed) linear blocks and translations.
+
+        Mapping coordinates involves only these parts of the homogeneous
+        matrices (never their last rows), so they are extracted once and cached.
+
+        """
+        if inverse not in self._split_matrix:
+            affine = self._inverse if inverse else self._matrix
+            dim = affine.shape[-1] - 1
+            self._split_matrix[inverse] = (
+                np.ascontiguousarray(np.swapaxes(affine[:, :dim, :dim], 1, 2)),
+                np.ascontiguousarray(affine[:, :dim, dim]),
+            )
+        return self._split_matrix[inverse]
 
     def to_filename(self, filename, fmt="X5", moving=None):
         """Store the transform in the requested output format."""
@@ -411,6 +546,7 @@ class LinearTransformsMapping(Affine):
         cval=0.0,
         prefilter=True,
         output_dtype=None,
+        n_jobs=1,
     ):
         """
         Apply a transformation to an image, resampling on the reference spatial object.
@@ -439,6 +575,12 @@ class LinearTransformsMapping(Affine):
             slightly blurred if *order > 1*, unless the input is prefiltered,
             i.e. it is the result of calling the spline filter on the original
             input.
+        n_jobs : int or None, optional
+            Number of timepoints resampled concurrently, default is 1.
+            If ``None`` or non-positive, all the CPUs this process may run on
+            are used. Each concurrent timepoint holds its own block of
+            coordinates (and, for 4D inputs, its own filtered volume), so peak
+            memory grows with the number of jobs.
 
         Returns
         -------
@@ -461,9 +603,6 @@ class LinearTransformsMapping(Affine):
         input_dtype = get_obj_dtype(spatialimage.dataobj)
         output_dtype = output_dtype or input_dtype
 
-        # Prepare physical coordinates of input (grid, points)
-        xcoords = _ref.ndcoords.astype("f4").T
-
         # Invert target's (moving) affine once
         ras2vox = ~Affine(spatialimage.affine)
 
@@ -475,37 +614,90 @@ class LinearTransformsMapping(Affine):
 
         # Order F ensures individual volumes are contiguous in memory
         # Also matches NIfTI, making final save more efficient
-        resampled = np.zeros(
-            (xcoords.shape[0], len(self)), dtype=output_dtype, order="F"
-        )
+        # Every sample is interpolated straight into this array (and cast to
+        # the output dtype, e.g. integers, on the fly), so no need to zero it
+        resampled = np.empty((_ref.npoints, len(self)), dtype=output_dtype, order="F")
 
+        # Read 4D data in one go too (unless too large), as slicing volumes
+        # one by one out of a (possibly compressed) file is much slower
         dataobj = (
             np.asanyarray(spatialimage.dataobj, dtype=input_dtype)
             if spatialimage.ndim in (2, 3)
+            or np.prod(spatialimage.shape) * np.dtype(input_dtype).itemsize
+            <= _PRELOAD_MAX_BYTES
             else None
         )
 
-        for t, xfm_t in enumerate(self):
-            # Map the input coordinates on to timepoint t of the target (moving)
-            ycoords = xfm_t.map(xcoords)[..., : _ref.ndim]
-
-            # Calculate corresponding voxel coordinates
-            yvoxels = ras2vox.map(ycoords)[..., : _ref.ndim]
-
-            # Interpolate
-            resampled[..., t] = ndi.map_coordinates(
-                (
-                    dataobj
-                    if dataobj is not None
-                    else spatialimage.dataobj[..., t].astype(input_dtype, copy=False)
-                ),
-                yvoxels.T,
-                output=output_dtype,
-                order=order,
-                mode=mode,
-                cval=cval,
-                prefilter=prefilter,
-            )
+        # Compose each timepoint's transform with the target's RAS-to-voxel
+        # affine once, so that coordinates are mapped with a single product.
+        # Composition runs in double precision, but mapping stays in single
+        # precision, which suffices for voxel coordinates.
+        fused = np.matmul(ras2vox.matrix, self._matrix)
+        if isinstance(_ref, ImageGrid):
+            # Also compose with the reference's affine and map grid indexes
+            # directly, so that physical coordinates are never materialized
+            fused = np.matmul(fused, _ref.affine)
+        fused = fused.astype("f4")
+
+        # Spline coefficients are calculated once per volume (not once per
+        # block nor timepoint), so that blocks are interpolated with
+        # ``prefilter=False`` below. 2D/3D data are shared by all timepoints.
+        filtered = prefilter and order > 1
+        npad = 0
+        if filtered and spatialimage.ndim in (2, 3):
+            dataobj, npad = _spline_filter(dataobj, order, mode, cval)
+
+        def _resample_volume(t):
+            data_t, npad_t = dataobj, npad
+            if spatialimage.ndim == 4:
+                data_t = (
+                    spatialimage.dataobj[..., t].astype(input_dtype, copy=False)
+                    if dataobj is None
+                    else dataobj[..., t]
+                )
+                if filtered:
+                    data_t, npad_t = _spline_filter(data_t, order, mode, cval)
+
+            # Resample in blocks of samples to bound the size of coordinate arrays
+            for start in range(0, _ref.npoints, _BLOCK_SIZE):
+                stop = min(start + _BLOCK_SIZE, _ref.npoints)
+                xcoords = (
+                    np.array(
+                        np.unravel_index(np.arange(start, stop), _ref.shape),
+                        dtype="f4",
+                    )
+                    if isinstance(_ref, ImageGrid)
+                    else np.asarray(_ref.ndcoords[start:stop].T, dtype="f4")
+                )
+
+                # Map the input coordinates on to voxel coordinates of
+                # timepoint t of the target (moving)
+                yvoxels = (
+                    fused[t, : _ref.ndim, : _ref.ndim] @ xcoords
+                    + fused[t, : _ref.ndim, 3, np.newaxis]
+                    + npad_t
+                )
+
+                # Interpolate straight into the (contiguous) output block
+                ndi.map_coordinates(
+                    data_t,
+                    yvoxels,
+                    output=resampled[start:stop, t],
+                    order=order,
+                    mode=mode,
+                    cval=cval,
+                    prefilter=False,
+                )
+
+        # Timepoints are independent and map_coordinates releases the GIL,
+        # so they can be resampled in concurrent threads
+        n_jobs = _cpu_count() if n_jobs is None or n_jobs < 1 else n_jobs
+        if n_jobs == 1 or len(self) == 1:
+            for t in range(len(self)):
+                _resample_volume(t)
+        else:
+            with ThreadPoolExecutor(max_workers=min(n_jobs, len(self))) as pool:
+                list(pool.map(_resample_volume, range(len(self))))
 
         if isinstance(_ref, ImageGrid):  # If reference is grid, reshape
             newdata = resampled.reshape(_ref.shape + (len(self),))
@@ -539,3 +731,119 @@ def load(filename, fmt=None, reference=None, moving=None):
         xfm = xfm[0]
 
     return xfm
+
+
+def _affine_inv(matrix):
+    r"""
+    Invert one or a stack of homogeneous affines in closed form.
+
+    Since the last row is (0, ..., 0, 1), only the linear block needs to be
+    inverted, and the inverse translation follows as
+    :math:`-\mathbf{R}^{-1} \mathbf{t}`.
+
+    Examples
+    --------
+    >>> matrix = np.stack([
+    ...     from_matvec(np.diag((2, 4, 0.5)), (4, -2, 1)),
+    ...     from_matvec(np.eye(3)[::-1], (1, 2, 3)),
+    ... ])
+    >>> np.allclose(_affine_inv(matrix), np.linalg.inv(matrix))
+    True
+
+    """
+    dim = matrix.shape[-1] - 1
+    rot_inv = np.linalg.inv(matrix[..., :dim, :dim])
+
+    inverse = np.zeros(matrix.shape, dtype=rot_inv.dtype)
+    inverse[..., :dim, :dim] = rot_inv
+    inverse[..., :dim, dim] = -np.einsum("...ij,...j->...i", rot_inv, matrix[..., :dim, dim])
+    inverse[..., dim, dim] = 1
+    return inverse
+
+
+def _cpu_count():
+    """Count the CPUs this process may run on (honoring its affinity mask)."""
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:  # Not available on all platforms (e.g., macOS)
+        return os.cpu_count() or 1
+
+
+def _spline_filter(data, order, mode, cval):
+    """
+    Calculate spline coefficients as :obj:`scipy.ndimage.map_coordinates` does.
+
+    The data array is pre-padded for the modes that SciPy pre-pads itself,
+    and the returned offset must be added to the voxel coordinates before
+    interpolating the coefficients with ``prefilter=False``.
+
+    """
+    npad = 0
+    if mode == "nearest":
+        npad = 12
+        data = np.pad(data, npad, mode="edge")
+    elif mode == "grid-constant":
+        npad = 12
+        data = np.pad(data, npad, mode="constant", constant_values=cval)
+
+    return ndi.spline_filter(data, order=order, output=np.float64, mode=mode), npad
+
+
+def _sniff_format(filename, nbytes=4096):
+    """
+    Guess the format of a linear transform file from its extension or header.
+
+    Only the first ``nbytes`` of the file are read.
+    Returns ``None`` when the file does not exist or the guess is ambiguous.
+
+    Examples
+    --------
+    >>> _sniff_format(regress_dir / "affine-LAS.itk.tfm")
+    'itk'
+
+    >>> _sniff_format(regress_dir / "affine-LAS.fs.lta")
+    'lta'
+
+    >>> _sniff_format(regress_dir / "affine-LAS.afni-array")
+    'afni'
+
+    >>> _sniff_format(regress_dir / "affine-LAS.fsl")
+    'fsl'
+
+    >>> _sniff_format("doesnotexist.tfm") is None
+    True
+
+    """
+    if Path(filename).suffix == ".h5":
+        return "itk"
+
+    try:
+        with open(str(filename), "rb") as fileobj:
+            header = fileobj.read(nbytes)
+    except OSError:
+        return None
+
+    if header.startswith(b"\x89HDF"):
+        return "itk"
+
+    # ITK writes binary MATLAB files, whereas FLIRT's ``.mat`` are plain text
+    if Path(filename).suffix == ".mat" and (
+        header.startswith(b"MATLAB") or b"\x00" in header
+    ):
+        return "itk"
+
+    for line in header.decode(errors="ignore").splitlines():
+        line = line.strip()
+        if line.startswith("#Insight Transform File"):
+            return "itk"
+        if "3dvolreg matrices" in line:
+            return "afni"
+        if not line or line.startswith("#"):
+            continue
+        if line.startswith("type"):
+            return "lta"
+
+        # First row of numbers: AFNI writes 12 per line, FSL four
+        return {12: "afni", 4: "fsl"}.get(len(line.split()))
+
+    return None
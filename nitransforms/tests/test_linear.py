@@ -9,6 +9,7 @@ import shutil
 import h5py
 
 import nibabel as nb
+from scipy import ndimage as ndi
 from nibabel.eulerangles import euler2mat
 from nibabel.affines import from_matvec
 from nitransforms import linear as nitl
@@ -78,6 +79,43 @@ def test_linear_load_mistaken(data_path):
         nitl.load(data_path / "itktflist2.tfm", fmt="afni")
 
 
+@pytest.mark.parametrize(
+    "fname,fmt",
+    [
+        ("affine-LAS.itk.tfm", "itk"),
+        ("itktflist2.tfm", "itk"),
+        ("affine-LAS.fs.lta", "lta"),
+        ("affine-LAS.afni", "afni"),
+        ("affine-LAS.afni-array", "afni"),
+        ("affine-LAS.fsl", "fsl"),
+        ("flirt.mat", "fsl"),  # FLIRT's plain-text matrices, named as FLIRT does
+        ("itk.mat", "itk"),  # ITK's binary MATLAB files
+    ],
+)
+def test_linear_load_sniffed(tmp_path, data_path, fname, fmt):
+    """Check loading with a guessed format matches loading with the format given."""
+    ref_file = tmp_path / "reference.nii.gz"
+    nb.Nifti1Image(
+        np.zeros((10, 11, 12), dtype="uint8"), np.diag((2.0, 2.0, 2.0, 1.0))
+    ).to_filename(ref_file)
+
+    if fname == "flirt.mat":
+        shutil.copy(data_path / "affine-LAS.fsl", tmp_path / fname)
+    elif fname == "itk.mat":
+        io.itk.ITKLinearTransform.from_filename(
+            data_path / "affine-LAS.itk.tfm"
+        ).to_filename(tmp_path / fname)
+    else:
+        shutil.copy(data_path / fname, tmp_path / fname)
+
+    assert nitl._sniff_format(tmp_path / fname) == fmt
+
+    xfm = nitl.load(tmp_path / fname, reference=ref_file, moving=ref_file)
+    expected = nitl.load(tmp_path / fname, fmt=fmt, reference=ref_file, moving=ref_file)
+    assert type(xfm) is type(expected)
+    assert np.allclose(xfm.matrix, expected.matrix)
+
+
 def test_loadsave_itk(tmp_path, data_path, testdata_path):
     """Test idempotency."""
     ref_file = testdata_path / "someones_anatomy.nii.gz"
@@ -379,3 +417,146 @@ def test_mulmat_operator(testdata_path):
     composed = nitl.Affine(mat2) @ aff
     assert composed.reference == aff.reference
     assert composed == nitl.Affine(mat2.dot(mat1), reference=ref)
+
+
+@pytest.fixture
+def hmc_matrices():
+    """Generate a short series of random, small head motions."""
+    rng = np.random.default_rng(1234)
+    return np.stack([
+        from_matvec(euler2mat(*rng.normal(scale=0.05, size=3)), rng.normal(size=3))
+        for _ in range(3)
+    ])
+
+
+@pytest.fixture
+def hmc_reference():
+    """Generate a small, isotropic reference grid."""
+    return nb.Nifti1Image(
+        np.zeros((15, 16, 17), dtype="uint8"), from_matvec(2.7 * np.eye(3), (-18, -20, -19))
+    )
+
+
+@pytest.mark.parametrize("order", [0, 1, 3])
+@pytest.mark.parametrize("mode", ["constant", "nearest", "reflect"])
+@pytest.mark.parametrize("shape", [(20, 22, 18), (20, 22, 18, 3)])
+@pytest.mark.parametrize("n_jobs", [1, 2])
+def test_LinearTransformsMapping_apply_blocks(
+    monkeypatch, hmc_matrices, hmc_reference, order, mode, shape, n_jobs
+):
+    """Check resampling in blocks matches resampling relying on SciPy only."""
+    rng = np.random.default_rng(1234)
+    affine = from_matvec(np.diag([2.0, 2.5, 3.0]).dot(euler2mat(0.1, 0.2, -0.05)), (-20, -25, -15))
+    moving = nb.Nifti1Image(rng.normal(size=shape).astype("float32"), affine)
+    hmc = nitl.LinearTransformsMapping(hmc_matrices, reference=hmc_reference)
+
+    # Force several (and uneven) blocks per volume
+    monkeypatch.setattr(nitl, "_BLOCK_SIZE", 1000)
+    moved = hmc.apply(moving, order=order, mode=mode, cval=0.3, n_jobs=n_jobs)
+
+    ref_coords = nitl.ImageGrid(hmc_reference).ndcoords.T
+    expected = np.stack(
+        [
+            ndi.map_coordinates(
+                moving.dataobj[..., t] if len(shape) == 4 else moving.dataobj,
+                nitl.Affine(np.linalg.inv(affine).dot(m)).map(ref_coords).T,
+                order=order,
+                mode=mode,
+                cval=0.3,
+            )
+            for t, m in enumerate(hmc_matrices)
+        ],
+        axis=-1,
+    ).reshape(moved.shape)
+    assert np.allclose(moved.dataobj, expected, atol=1e-4)
+
+
+def test_LinearTransformsMapping_apply_pointset(monkeypatch, hmc_matrices, hmc_reference):
+    """Check resampling on a surface/point-cloud reference, in blocks."""
+    rng = np.random.default_rng(1234)
+    moving = nb.Nifti1Image(
+        rng.normal(size=(20, 22, 18, 3)).astype("float32"),
+        from_matvec(np.diag([2.0, 2.5, 3.0]), (-20, -25, -15)),
+    )
+    hmc = nitl.LinearTransformsMapping(hmc_matrices)
+    gii = nb.gifti.GiftiImage(
+        darrays=[
+            nb.gifti.GiftiDataArray(
+                data=nitl.ImageGrid(hmc_reference).ndcoords.T.astype("float32"),
+                intent=nb.nifti1.intent_codes["pointset"],
+            )
+        ]
+    )
+
+    monkeypatch.setattr(nitl, "_BLOCK_SIZE", 1000)
+    moved = hmc.apply(moving, reference=gii, order=1)
+    assert moved.shape == (15 * 16 * 17, 3)
+
+    expected = hmc.apply(moving, reference=hmc_reference, order=1)
+    assert np.allclose(moved, np.asanyarray(expected.dataobj).reshape(-1, 3), atol=1e-4)
+
+
+def test_LinearTransformsMapping_mulmat_operator(hmc_matrices):
+    """Check the @ operator composes every transform of a series at once."""
+    series = nitl.LinearTransformsMapping(hmc_matrices)
+    aff = nitl.Affine(from_matvec(np.diag([2.0, 2.0, 2.0]), (4, 2, -1)))
+
+    composed = series @ aff
+    assert isinstance(composed, nitl.LinearTransformsMapping)
+    assert np.allclose(composed.matrix, [m.dot(aff.matrix) for m in hmc_matrices])
+
+    composed = aff @ series
+    assert isinstance(composed, nitl.LinearTransformsMapping)
+    assert np.allclose(composed.matrix, [aff.matrix.dot(m) for m in hmc_matrices])
+
+    # Affine's own product must not build an Affine from a series
+    with pytest.raises(TypeError):
+        nitl.Affine.__matmul__(aff, series)
+
+    composed = series @ ~series
+    assert np.allclose(composed.matrix, np.eye(4))
+
+    composed = series @ [nitl.Affine(m) for m in np.linalg.inv(hmc_matrices)]
+    assert isinstance(composed, nitl.LinearTransformsMapping)
+    assert np.allclose(composed.matrix, np.eye(4))
+
+    with pytest.raises(ValueError):
+        nitl.LinearTransformsMapping(np.ones((3, 4, 4)))
+
+    with pytest.raises(TypeError):
+        nitl.LinearTransformsMapping(np.ones((3, 4, 3)))
+
+
+def test_map_homogeneous():
+    """Check homogeneous coordinates are translated according to their w."""
+    xfm = nitl.Affine([[2, 0, 0, 10], [0, 1, 0, 20], [0, 0, 1, 30], [0, 0, 0, 1]])
+    hpoints = [[1, 0, 0, 0], [1, 1, 1, 2], [1, 1, 1, 1]]
+    assert np.allclose(xfm.map(hpoints), [[2, 0, 0], [22, 41, 61], [12, 21, 31]])
+    assert np.allclose(
+        xfm.map(hpoints, inverse=True), [[0.5, 0, 0], [-9.5, -39, -59], [-4.5, -19, -29]]
+    )
+
+    series = nitl.LinearTransformsMapping([xfm.matrix, np.eye(4)])
+    mapped = series.map(hpoints)
+    assert mapped.shape == (2, 3, 3)
+    assert np.allclose(mapped[0], xfm.map(hpoints))
+    assert np.allclose(mapped[1], np.array(hpoints)[:, :3])
+    assert np.allclose(series.map(hpoints, inverse=True)[0], xfm.map(hpoints, inverse=True))
+
+
+def test_map_contiguous(hmc_matrices):
+    """Check mapped coordinates are returned in C-contiguous arrays."""
+    rng = np.random.default_rng(1234)
+    points = rng.normal(size=(100, 3))
+    # Homogeneous coordinates, transposed (i.e., a non-contiguous input)
+    hpoints = np.vstack((points.T, np.ones((1, 100)))).T
+
+    series = nitl.LinearTransformsMapping(hmc_matrices)
+    for inverse in (False, True):
+        mapped = series.map(hpoints, inverse=inverse)
+        assert mapped.shape == (len(hmc_matrices), 100, 3)
+        assert mapped.flags.c_contiguous
+
+        for t, xfm in enumerate(series):
+            assert np.allclose(mapped[t], xfm.map(points, inverse=inverse))
+            assert xfm.map(hpoints, inverse=inverse).flags.c_contiguous